@@ -1,13 +1,51 @@
 import os
-import json
+import email.utils
 import asyncio
+import aiofiles
 import aiohttp
 import random
 import logging
+import orjson
+import polars as pl
+from aiolimiter import AsyncLimiter
+from datetime import datetime, timezone
 from pathlib import Path
 from dotenv import load_dotenv
 from dataclasses import dataclass, field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Optional
+
+
+# Shapes each year's Parquet file to match the carbon_footprint table in the
+# ingestion step, which loads columns by position: snake_case names, DDL column
+# order, and narrowed numeric types (16-bit year/country_code, Float32 measures)
+COLUMN_RENAME: Dict[str, str] = {
+    "countryCode": "country_code",
+    "countryName": "country_name",
+    "shortName": "short_name",
+    "cropLand": "crop_land",
+    "grazingLand": "grazing_land",
+    "forestLand": "forest_land",
+    "fishingGround": "fishing_ground",
+    "builtupLand": "builtup_land"
+}
+
+TARGET_COLUMNS: List[str] = [
+    "year", "country_code", "country_name", "short_name", "isoa2", "record",
+    "crop_land", "grazing_land", "forest_land", "fishing_ground",
+    "builtup_land", "carbon", "value", "score"
+]
+
+SCHEMA_CASTS: Dict[str, type] = {
+    "year": pl.UInt16,
+    "country_code": pl.UInt16,
+    "crop_land": pl.Float32,
+    "grazing_land": pl.Float32,
+    "forest_land": pl.Float32,
+    "fishing_ground": pl.Float32,
+    "builtup_land": pl.Float32,
+    "carbon": pl.Float32,
+    "value": pl.Float32
+}
 
 
 # --- Configuration using Dataclass ---
@@ -19,7 +57,8 @@ class APIConfig:
     api_key: str
     raw_data_dir: Path = Path("../local_storage/raw")
     log_file: Path = Path("../logs/local_data_extraction.log")
-    max_concurrent: int = 5  # Semaphore limit for API calls
+    max_concurrent: int = 5  # Semaphore limit for simultaneous connections
+    max_requests_per_minute: int = 10  # Token-bucket limit matching the API quota
     max_retries: int = 5
     initial_delay: float = 1.0  # Initial wait time for backoff
     timeout_seconds: float = 30.0  # Total timeout for a single request
@@ -43,62 +82,166 @@ def setup_logging(log_file: Path):
     )
 
 
-def increase_delay(delay: float) -> float:
-    """Doubles the delay with exponential backoff, capped at 60 seconds"""
-    # Adds a small exponential + random delay between 1 and 2
+def full_jitter_delay(attempt: int, base: float, cap: float = 60.0) -> float:
+    """
+    Computes the wait time for a retry using the AWS "full jitter" formula:
+    sleep = uniform(0, min(cap, base * 2 ** (attempt - 1)))
+    Spreads concurrent retries over the whole window to avoid synchronized bursts
+    """
+
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+
+def parse_retry_after(header_value: Optional[str]) -> Optional[float]:
+    """
+    Parses a Retry-After header (either delay-seconds or an HTTP-date)
+    Returns the wait time in seconds, capped at 60, or None if the header is missing/invalid
+    """
+
+    if not header_value:
+        return None
+
+    try:
+        if header_value.isdigit():
+            seconds = float(header_value)
+        else:
+            retry_at = email.utils.parsedate_to_datetime(header_value)
+            seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(max(seconds, 0.0), 60.0)
+    except (ValueError, TypeError):
+        return None
+
+def meta_path(filepath: Path) -> Path:
+    """Returns the path of the sidecar file storing HTTP cache validators"""
 
-    return min(delay * 2 * random.uniform(1, 2), 60.0)
+    return filepath.with_suffix(filepath.suffix + ".meta")
 
-def save_local(data: Dict[str, Any], filepath: Path):
-    """Saves data to local storage"""
+def read_conditional_headers(filepath: Path) -> Dict[str, str]:
+    """
+    Reads stored ETag / Last-Modified validators for a previously fetched file
+    Returns If-None-Match / If-Modified-Since headers for a conditional GET, or {} if unavailable
+    """
 
     try:
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
-        logging.info(f"Saved: {filepath}")
+        with open(meta_path(filepath), "rb") as f:
+            meta = orjson.loads(f.read())
+    except (IOError, orjson.JSONDecodeError):
+        return {}
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+def save_cache_meta(filepath: Path, resp: aiohttp.ClientResponse):
+    """Stores the response's ETag / Last-Modified next to the data file for future conditional GETs"""
+
+    meta = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified")
+    }
+    if not any(meta.values()):
+        return
+
+    try:
+        with open(meta_path(filepath), "wb") as f:
+            f.write(orjson.dumps(meta))
     except IOError as e:
-        logging.error(f"Failed to save file {filepath}: {e}")
+        logging.warning(f"Failed to save cache metadata {meta_path(filepath)}: {e}")
+
+def convert_to_parquet(src: Path, dest: Path):
+    """
+    Converts a downloaded JSON payload into a zstd-compressed Parquet file,
+    already renamed, column-ordered and downcast for the carbon_footprint table
+    Parquet as the interchange format means the ingestion step never touches
+    JSON text again and the on-disk footprint shrinks several-fold
+    Raises if the payload is not valid JSON or misses expected columns
+    """
+
+    df = (
+        pl.read_json(src)
+        .rename(COLUMN_RENAME)
+        .select(TARGET_COLUMNS)
+        .cast(SCHEMA_CASTS)
+    )
+    df.write_parquet(dest, compression="zstd", statistics=True)
+    src.unlink()
+
+async def stream_to_file(resp: aiohttp.ClientResponse, filepath: Path, chunk_size: int = 64 * 1024):
+    """
+    Streams the response body to disk chunk by chunk
+    Avoids materializing the whole payload in memory and re-serializing it
+    """
+
+    async with aiofiles.open(filepath, "wb") as f:
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            await f.write(chunk)
+    logging.info(f"Saved: {filepath}")
 
 
 async def fetch_year(
         session: aiohttp.ClientSession,
         year: int,
         semaphore: asyncio.Semaphore,
+        limiter: AsyncLimiter,
+        abort: asyncio.Event,
         config: APIConfig
 ) -> Optional[str]: # It returns None if it's successful, but may return an error message if it fails
     """
     Fetches data for a specific year from the API with retries and backoff
     Returns None on success or a string error message on failure
+    Raises on 401/403 after setting the shared abort event, so the TaskGroup cancels the siblings
     """
 
     endpoint = f"{config.api_url}/data/all/{year}"
-    filename = f"data_all_{year}.json"
+    filename = f"data_all_{year}.parquet"
     filepath = config.raw_data_dir / filename
 
+    conditional_headers: Dict[str, str] = {}
     if filepath.exists():
-        logging.info(f"Year {year}: already exists, skipping...")
-        return None
-
-    delay = config.initial_delay
+        # Revalidates existing files with a conditional GET when validators were stored,
+        # otherwise keeps the old skip-if-present behaviour
+        # Sidecar I/O runs in a worker thread so it never blocks the event loop
+        conditional_headers = await asyncio.to_thread(read_conditional_headers, filepath)
+        if not conditional_headers:
+            logging.info(f"Year {year}: already exists, skipping...")
+            return None
+
+    # Headers and timeout are identical for every attempt, so build them once
+    request_headers = {"Accept": "application/json", **conditional_headers}
+    timeout = aiohttp.ClientTimeout(total=config.timeout_seconds)
 
     for attempt in range(1, config.max_retries + 1):
-        try:
-            async with semaphore:
-                timeout = aiohttp.ClientTimeout(total=config.timeout_seconds)
+        # Gives up straight away if another task already hit a credential error
+        if abort.is_set():
+            return "Aborted after permanent error in another task"
 
+        try:
+            # The limiter paces request *rate* to the API quota; the semaphore only
+            # bounds how many connections are open at once
+            async with limiter, semaphore:
                 async with session.get(
                         endpoint,
-                        headers={"Accept": "application/json"},
+                        headers=request_headers,
                         timeout=timeout
                 ) as resp:
 
+                    # Upstream data unchanged since last fetch, local copy is still valid
+                    if resp.status == 304:
+                        logging.info(f"Year {year}: not modified upstream, keeping local copy")
+                        return None
+
                     # Handles ALL Server Errors (5xx) and Rate Limiting (429) for retrying
                     if resp.status == 429 or 500 <= resp.status <= 599:
+                        # Prefers the server-supplied Retry-After over our own backoff
+                        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                        wait = retry_after if retry_after is not None else full_jitter_delay(attempt, config.initial_delay)
+
                         logging.warning(
-                            f"Year {year}: attempt {attempt}/{config.max_retries}, Status {resp.status}, waiting {delay:.1f}s…"
+                            f"Year {year}: attempt {attempt}/{config.max_retries}, Status {resp.status}, waiting {wait:.1f}s…"
                         )
-                        await asyncio.sleep(delay)
-                        delay = increase_delay(delay)
+                        await asyncio.sleep(wait)
                         continue  # Go to next attempt
 
                     # Handles permanent errors
@@ -107,27 +250,49 @@ async def fetch_year(
 
                     # Success check
                     if resp.ok:
-                        data = await resp.json()  # This may raise json.JSONDecodeError if content is bad
-
-                        save_local(data, filepath)
+                        content_type = resp.headers.get("Content-Type", "")
+                        if "json" not in content_type:
+                            logging.error(f"Year {year}: unexpected content type '{content_type}'. Stopping retries")
+                            return f"Unexpected content type: {content_type}"
+
+                        tmp_path = filepath.with_suffix(".json.part")
+                        await stream_to_file(resp, tmp_path)
+
+                        # Re-shapes the payload into a table-ready Parquet file;
+                        # a conversion failure means the payload was malformed
+                        try:
+                            await asyncio.to_thread(convert_to_parquet, tmp_path, filepath)
+                        except Exception as e:
+                            bad_path = filepath.with_suffix(".bad")
+                            tmp_path.rename(bad_path)
+                            logging.error(f"Year {year}: malformed payload ({e}), moved to {bad_path}. Stopping retries")
+                            return "Malformed payload"
+
+                        await asyncio.to_thread(save_cache_meta, filepath, resp)
                         logging.info(f"Fetched {year} successfully")
 
-                        # Adds sleep after success in order to not stress the API
-                        await asyncio.sleep(random.uniform(0.3, 0.7))
+                        # No courtesy sleep needed here: the AsyncLimiter already
+                        # paces requests to the API quota
                         return None  # Success
 
         except aiohttp.ClientResponseError as e:
             # Catches specific errors like 404, 401, etc. They are permanent failures
+            if e.status in (401, 403):
+                # Credentials are wrong for every year, not just this one:
+                # signal the siblings and abort the whole TaskGroup
+                logging.error(f"Year {year}: Auth error {e.status} - {e.message}. Aborting all fetches")
+                abort.set()
+                raise
             logging.error(f"Year {year}: Permanent HTTP Error: {e.status} - {e.message}. Stopping retries")
             return f"Permanent HTTP Error: {e.status} - {e.message}"
 
-        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
-            # Catches transient network/decoding errors
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            # Catches transient network/write errors
+            wait = full_jitter_delay(attempt, config.initial_delay)
             logging.warning(
-                f"Year {year}: attempt {attempt}/{config.max_retries} failed: {type(e).__name__} - {e}, retrying in {delay:.1f}s"
+                f"Year {year}: attempt {attempt}/{config.max_retries} failed: {type(e).__name__} - {e}, retrying in {wait:.1f}s"
             )
-            await asyncio.sleep(delay)
-            delay = increase_delay(delay)
+            await asyncio.sleep(wait)
 
     # If the loop finishes without success
     logging.error(f"Failed to fetch year {year} after {config.max_retries} attempts")
@@ -157,21 +322,40 @@ async def main():
     logging.info(f"Max concurrent connections: {config.max_concurrent}")
 
     semaphore = asyncio.Semaphore(config.max_concurrent)
+    limiter = AsyncLimiter(config.max_requests_per_minute, time_period=60)
+    abort = asyncio.Event()
     failures = 0
     total_years = len(config.years_to_fetch)
 
-    async with aiohttp.ClientSession(auth=global_auth_header) as session:
-        tasks = [fetch_year(session, year, semaphore, config) for year in config.years_to_fetch]
-
-        # Gathers results and exceptions
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+    # Shares one tuned connection pool across all fetches: connections stay warm
+    # between requests (one TLS handshake per host instead of one per year) and
+    # DNS lookups are cached for the whole run
+    connector = aiohttp.TCPConnector(
+        limit=config.max_concurrent,
+        limit_per_host=config.max_concurrent,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True,
+        ttl_dns_cache=600
+    )
 
-        for result in results:
-            if isinstance(result, str):
+    async with aiohttp.ClientSession(connector=connector, auth=global_auth_header, trust_env=True) as session:
+        tasks = {}
+        try:
+            # The TaskGroup cancels every sibling as soon as one task raises,
+            # so a credential error fails the run fast instead of letting all
+            # years burn their full retry budget
+            async with asyncio.TaskGroup() as tg:
+                tasks = {
+                    year: tg.create_task(fetch_year(session, year, semaphore, limiter, abort, config))
+                    for year in config.years_to_fetch
+                }
+        except* aiohttp.ClientResponseError as eg:
+            logging.critical(f"Extraction aborted, remaining fetches cancelled: {eg.exceptions[0]}")
+
+        for year, task in tasks.items():
+            if task.cancelled() or task.exception() is not None:
                 failures += 1
-            # Handles unexpected exceptions during gather
-            elif isinstance(result, Exception):
-                logging.critical(f"Unhandled exception during task gathering: {result}")
+            elif isinstance(task.result(), str):
                 failures += 1
 
     # Summary
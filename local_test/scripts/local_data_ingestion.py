@@ -1,10 +1,10 @@
+import os
 import sys
 import logging
 from pathlib import Path
-from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Union
+from dataclasses import dataclass
+from typing import List, Optional, Union
 import duckdb
-import polars as pl
 
 
 # --- Configuration using Dataclass ---
@@ -16,36 +16,24 @@ class IngestionConfig:
     duckdb_path: Path = Path("../local_storage/footprint.duckdb")
     log_file: Path = Path("../logs/local_data_ingestion.log")
 
-    # Column mapping for renaming during transformation
-    column_mapping: Dict[str, str] = field(default_factory=lambda: {
-        "countryCode": "country_code",
-        "countryName": "country_name",
-        "cropLand": "crop_land",
-        "grazingLand": "grazing_land",
-        "forestLand": "forest_land",
-        "fishingGround": "fishing_ground",
-        "builtupLand": "builtup_land"
-    })
-
     # SQL DDL
     target_table_sql: str = """
         CREATE TABLE IF NOT EXISTS carbon_footprint (
-            year INTEGER,
-            country_code INTEGER,
+            year USMALLINT,
+            country_code USMALLINT,
             country_name VARCHAR,
             short_name VARCHAR,
             isoa2 VARCHAR,
             record VARCHAR,
-            crop_land DOUBLE,
-            grazing_land DOUBLE,
-            forest_land DOUBLE,
-            fishing_ground DOUBLE,
-            builtup_land DOUBLE,
-            carbon DOUBLE,
-            value DOUBLE,
+            crop_land REAL,
+            grazing_land REAL,
+            forest_land REAL,
+            fishing_ground REAL,
+            builtup_land REAL,
+            carbon REAL,
+            value REAL,
             score VARCHAR
         );
-        TRUNCATE TABLE carbon_footprint;
     """
 
 
@@ -78,81 +66,117 @@ def connect_duckdb(db_path: Path) -> Optional[duckdb.DuckDBPyConnection]:
         return None
 
 
-def extract_and_transform(config: IngestionConfig) -> Optional[pl.DataFrame]:
-    """Reads and concatenates all JSON files into a single Polars DataFrame"""
+def discover_parquet_files(config: IngestionConfig) -> Optional[List[str]]:
+    """Lists the per-year Parquet files produced by the extraction step"""
 
     config.raw_data_dir.mkdir(parents=True, exist_ok=True)
-    # Collects JSON Files
-    json_files: List[Path] = config.raw_data_dir.glob("*.json")
-    if not json_files:
-        logging.warning(f"No JSON files found in {config.raw_data_dir}. Exiting")
-        return None
-
-    # Reads and Concatenates JSON Files
-    df_list: List[pl.DataFrame] = []
-    for json_file in json_files:
-        try:
-            logging.info(f"Processing {json_file.name}...")
-            # Uses pl.read_json which is efficient for structured JSON
-            df_list.append(pl.read_json(json_file))
-        except Exception as e:
-            logging.error(f"Failed to read {json_file}: {e}")
-
-    if not df_list:
-        logging.error("No JSON data could be successfully read. Exiting...")
+    # os.scandir with a suffix check skips the per-entry fnmatch cost of glob
+    parquet_files: List[str] = sorted(
+        entry.path
+        for entry in os.scandir(config.raw_data_dir)
+        if entry.is_file() and entry.name.endswith(".parquet")
+    )
+    if not parquet_files:
+        logging.warning(f"No Parquet files found in {config.raw_data_dir}. Exiting")
         return None
 
-    # Concatenates and Transforms data
-    full_df = pl.concat(df_list, rechunk=True)
-
-    logging.info(f"Total records loaded from JSON: {full_df.shape[0]}")
+    logging.info(f"Found {len(parquet_files)} Parquet files to load")
+    return parquet_files
 
-    full_df = full_df.rename(config.column_mapping)
-    logging.info("DataFrame columns renamed for SQL compatibility")
 
-    return full_df
-
-
-def load_data(con: duckdb.DuckDBPyConnection, df: pl.DataFrame, sql_setup: str) -> bool:
-    """Prepares the database table and loads the DataFrame"""
+def load_data(con: duckdb.DuckDBPyConnection, parquet_files: List[str], config: IngestionConfig) -> bool:
+    """Prepares the database table and loads the per-year Parquet files"""
 
     try:
-        # Setup Table (Creates and Truncates)
-        con.sql(sql_setup)
-        logging.info("Table 'carbon_footprint' is ready (truncated for clean ETL)")
-
-        # Inserts polars df
-        con.sql("INSERT INTO carbon_footprint SELECT * FROM df")
-        logging.info(f"Successfully loaded {df.shape[0]} records into DuckDB")
+        # Setup Table
+        con.sql(config.target_table_sql)
+        logging.info("Table 'carbon_footprint' is ready")
+
+        # Upstream revisions must replace their old rows: any year whose staged
+        # data contains rows not already in the table (new or changed by a
+        # re-fetch) is deleted first, then refilled below. Unchanged years
+        # produce an empty EXCEPT and are never touched
+        refreshed = con.execute(
+            """
+            DELETE FROM carbon_footprint
+             WHERE year IN (
+                   SELECT DISTINCT year FROM (
+                          SELECT * FROM read_parquet(?)
+                          EXCEPT
+                          SELECT * FROM carbon_footprint
+                   )
+             )
+            """,
+            [parquet_files]
+        ).fetchone()[0]
+        if refreshed:
+            logging.info(f"Removed {refreshed} outdated records for refreshed years")
+
+        # The NOT EXISTS filter keeps warm re-runs incremental (only the years
+        # deleted above or never loaded have no rows left to match), and the
+        # ORDER BY lays rows out for zonemap pruning
+        inserted = con.execute(
+            """
+            INSERT INTO carbon_footprint
+            SELECT * FROM read_parquet(?) s
+             WHERE NOT EXISTS (
+                   SELECT 1 FROM carbon_footprint c
+                    WHERE c.country_code = s.country_code AND c.year = s.year
+             )
+             ORDER BY s.country_code, s.year
+            """,
+            [parquet_files]
+        ).fetchone()[0]
+        logging.info(f"Successfully loaded {inserted} new records into DuckDB")
+
+        # Rows arrive sorted by (country_code, year), so DuckDB's min/max
+        # zonemaps let per-country queries skip most row groups; the index
+        # speeds up point lookups on the same pair. It must not be unique:
+        # the API returns one row per record type per country and year
+        con.sql("CREATE INDEX IF NOT EXISTS idx_country_year ON carbon_footprint (country_code, year)")
         return True
     except Exception as e:
         logging.error(f"Failed to load data into DuckDB: {e}")
         return False
 
 
-def run_checks(con: duckdb.DuckDBPyConnection):
-    """Executes a few SQL queries to verify the loaded data"""
+def run_checks(con: duckdb.DuckDBPyConnection, country_name: str = "Brazil"):
+    """Executes a few SQL queries in a single transaction to verify the loaded data"""
 
     try:
         logging.info("\n--- Verification Queries ---")
 
+        # One read transaction for all checks avoids per-query snapshot setup,
+        # and the parameterized country filter lets repeated dashboard runs
+        # reuse the prepared plan instead of re-parsing a new literal each time
+        con.execute("BEGIN")
+
         logging.info("Total records count:")
-        logging.info(con.sql("SELECT count(1) FROM carbon_footprint").fetchone())
+        logging.info(con.execute("SELECT count(1) FROM carbon_footprint").fetchone())
 
         logging.info("Sample records:")
-        logging.info(con.sql("SELECT year, country_name, carbon FROM carbon_footprint LIMIT 2").fetchall())
+        logging.info(con.execute("SELECT year, country_name, carbon FROM carbon_footprint LIMIT 2").fetchall())
 
-        logging.info("Brazil carbon footprint evolution by Year:")
-        logging.info(con.sql("""
+        logging.info(f"{country_name} carbon footprint evolution by Year:")
+        logging.info(con.execute("""
             SELECT country_name, avg(carbon) AS avg_carbon, year
               FROM carbon_footprint
-             WHERE country_name = 'Brazil'
+             WHERE country_name = ?
              GROUP BY country_name, year
              ORDER BY year ASC
              LIMIT 2
-        """).fetchall())
+        """, [country_name]).fetchall())
+
+        con.execute("COMMIT")
 
     except Exception as e:
+        # No transaction is active if the failure happened at BEGIN itself or
+        # at COMMIT (DuckDB rolls a failed commit back on its own), so the
+        # rollback must not be allowed to raise and abort the pipeline
+        try:
+            con.execute("ROLLBACK")
+        except duckdb.TransactionException:
+            pass
         logging.error(f"Failed during verification queries: {e}")
 
 
@@ -169,13 +193,13 @@ def main():
         if con is None:
             sys.exit(1)
 
-        # Extracts and Transforms
-        full_df = extract_and_transform(config)
-        if full_df is None:
+        # Discovers extracted files
+        parquet_files = discover_parquet_files(config)
+        if parquet_files is None:
             sys.exit(0)  # Exit if no data
 
         # Loads Data
-        if not load_data(con, full_df, config.target_table_sql):
+        if not load_data(con, parquet_files, config):
             sys.exit(1)
 
         # Runs Checks